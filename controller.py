@@ -1,108 +1,249 @@
 #!/usr/bin/env python
 import asyncio
 import logging
-import time
+import signal
+import struct
 from contextlib import contextmanager
 from typing import Iterator
 
-import RPi.GPIO as GPIO
-from websockets.asyncio.server import ServerConnection, serve
+import pigpio
+from picows import (
+    WSCloseCode,
+    WSFrame,
+    WSListener,
+    WSMsgType,
+    WSTransport,
+    ws_create_server,
+)
 
-# The current movement command, consisting of a timeout, y strength, and x strength.
+log = logging.getLogger(__name__)
+
+# The last movement that we've followed, consisting of a y strength and x strength.
 # y represents forwards/backwards movement and x represents right/left movement.
 # Strength values should be in the range [-1, 1].
-movement: tuple[float, float, float] | None = None
-# The last movement command that we've followed, not including the timeout.
 last_movement: tuple[float, float] = (0, 0)
+# The event loop callback that stops the current movement once it times out.
+# Timeouts are relative to the event loop's clock, i.e. loop.time().
+movement_timer: asyncio.TimerHandle | None = None
+# Transports for each client connected to run_server().
+connections: set[WSTransport] = set()
+# Commands received from clients, waiting to be handled by process_commands().
+command_queue: asyncio.Queue[str | bytes] = asyncio.Queue(maxsize=64)
+
+# Binary movement command, consisting of a duration in milliseconds,
+# y strength, and x strength. Strength values are in the range [-100, 100].
+MOVE_COMMAND = struct.Struct("<Hbb")
+
+# Direction pins for both motors (BCM numbering, BOARD pins 7, 11, 13, and 15),
+# and the values and duty cycle to apply for each direction.
+# A duty cycle of None leaves the current one unchanged.
+MOTOR_PINS = (4, 17, 27, 22)
+MOTOR_PINS_MASK = sum(1 << pin for pin in MOTOR_PINS)
+# fmt: off
+MOTOR_DIRECTIONS: dict[str, tuple[tuple[bool, bool, bool, bool], float | None]] = {
+    "forward": ((False, True,  True,  False), 25),
+    "back":    ((True,  False, False, True),  30),
+    "right":   ((True,  False, True,  False), 20),
+    "left":    ((False, True,  False, True),  20),
+    "stop":    ((False, False, False, False), None),
+}
+# fmt: on
+
+# Hardware PWM pins (BCM numbering, BOARD pins 32 and 33) controlling motor speed.
+PWM_PINS = (12, 13)
+PWM_FREQUENCY = 255
+
+# The last values written to the motor pins, used to skip redundant writes.
+pin_values: tuple[bool, bool, bool, bool] | None = None
+duty_cycle: float | None = None
 
 
 async def main() -> None:
+    # systemd stops us with SIGINT (see KillSignal), but handle SIGTERM too
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    signals = (signal.SIGINT, signal.SIGTERM)
+    for sig in signals:
+        loop.add_signal_handler(sig, stop.set)
+
     with init_gpio():
         async with asyncio.TaskGroup() as tg:
-            tg.create_task(run_server())
-            tg.create_task(process_movement_queue())
+            tasks = [
+                tg.create_task(run_server()),
+                tg.create_task(process_commands()),
+                tg.create_task(stop.wait()),
+            ]
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+            # Restore the default handlers so a second signal can still
+            # interrupt us if shutting down gets stuck
+            log.info("Shutting down...")
+            for sig in signals:
+                loop.remove_signal_handler(sig)
+            for task in tasks:
+                task.cancel()
 
 
 @contextmanager
 def init_gpio() -> Iterator[None]:
-    global M1, M2
+    global pi
 
-    GPIO.setmode(GPIO.BOARD)
+    # pigpio keeps a persistent connection to its daemon, which writes
+    # directly to the GPIO registers and drives the hardware PWM peripheral
+    pi = pigpio.pi()
+    if not pi.connected:
+        raise RuntimeError("Could not connect to pigpio daemon, is pigpiod running?")
 
-    GPIO.setup(7, GPIO.OUT)
-    GPIO.setup(11, GPIO.OUT)
-    GPIO.setup(13, GPIO.OUT)
-    GPIO.setup(15, GPIO.OUT)
-    GPIO.setup(32, GPIO.OUT)
-    GPIO.setup(33, GPIO.OUT)
+    for pin in MOTOR_PINS:
+        pi.set_mode(pin, pigpio.OUTPUT)
 
-    M1 = GPIO.PWM(32, 255)
-    M2 = GPIO.PWM(33, 255)
-    M1.start(0)
-    M2.start(0)
+    for pin in PWM_PINS:
+        pi.set_mode(pin, pigpio.OUTPUT)
+        pi.hardware_PWM(pin, PWM_FREQUENCY, 0)
 
     try:
         yield
     finally:
-        M1.stop()
-        M2.stop()
-        GPIO.cleanup()
+        for pin in PWM_PINS:
+            pi.hardware_PWM(pin, 0, 0)
+        pi.clear_bank_1(MOTOR_PINS_MASK)
+
+        for pin in MOTOR_PINS + PWM_PINS:
+            pi.set_mode(pin, pigpio.INPUT)
+        pi.stop()
 
 
 async def run_server() -> None:
-    async with serve(handle_connection, "", 8555) as server:
-        print("Serving on port 8555!")
-        await server.serve_forever()
+    # picows never negotiates compression, which would be pure overhead for
+    # our tiny commands, and large frames can only come from misbehaving clients.
+    server = await ws_create_server(
+        lambda request: CommandListener(),
+        "",
+        8555,
+        max_frame_size=256,
+    )
+    async with server:
+        log.info("Serving on port 8555!")
+        try:
+            await asyncio.Future()  # Serve until cancelled
+        finally:
+            # Closing the server waits for every client to disconnect,
+            # so stop accepting connections and then kick existing clients
+            server.close()
+            for transport in list(connections):
+                transport.send_close(WSCloseCode.GOING_AWAY)
+                transport.disconnect()
+
+
+class CommandListener(WSListener):
+    remote_address: object = None
+
+    def on_ws_connected(self, transport: WSTransport) -> None:
+        self.remote_address = transport.underlying_transport.get_extra_info("peername")
+        log.info("Established connection from: %s", self.remote_address)
+        connections.add(transport)
 
+    def on_ws_frame(self, transport: WSTransport, frame: WSFrame) -> None:
+        if frame.msg_type == WSMsgType.BINARY:
+            queue_command(frame.get_payload_as_bytes())
+        elif frame.msg_type == WSMsgType.TEXT:
+            try:
+                queue_command(frame.get_payload_as_utf8_text())
+            except UnicodeDecodeError:
+                log.warning("Unknown command: %r", frame.get_payload_as_bytes())
+        elif frame.msg_type == WSMsgType.CLOSE:
+            transport.send_close(frame.get_close_code(), frame.get_close_message())
+            transport.disconnect()
 
-async def process_movement_queue() -> None:
+    def on_ws_disconnected(self, transport: WSTransport) -> None:
+        log.info("Closing connection: %s", self.remote_address)
+        connections.discard(transport)
+
+
+async def process_commands() -> None:
     while True:
-        await asyncio.sleep(0.25)
-        evaluate_movement()
+        command = await command_queue.get()
 
+        # Only the newest command matters when clients send them in bursts,
+        # so skip over any that piled up in the meantime
+        while not command_queue.empty():
+            command = command_queue.get_nowait()
+
+        # A bad command shouldn't take down the server along with this task
+        try:
+            handle_command(command)
+        except Exception:
+            log.exception("Failed to handle command: %r", command)
 
-async def handle_connection(ws: ServerConnection) -> None:
-    print("Established connection from:", ws.remote_address)
-    try:
-        async for message in ws:
-            if isinstance(message, str):
-                handle_command(message)
-    finally:
-        print("Closing connection:", ws.remote_address)
 
+def queue_command(command: str | bytes) -> None:
+    # If we're falling behind, drop the oldest command to make room
+    if command_queue.full():
+        command_queue.get_nowait()
+    command_queue.put_nowait(command)
 
-def handle_command(command: str) -> None:
+
+def handle_command(command: str | bytes) -> None:
     # New commands on the client should be added here
-    match command.split(":"):
-        case ["move", duration, y, x]:
-            timeout = time.perf_counter() + int(duration) / 1000
-            y = int(y) / 100
-            x = int(x) / 100
-            set_movement(timeout, y, x)
-        case _:
-            print("Unknown command:", command)
+    if isinstance(command, bytes):
+        if len(command) == MOVE_COMMAND.size:
+            duration, y, x = MOVE_COMMAND.unpack(command)
+            return handle_move_command(duration, y, x)
+    elif command.startswith("move:"):
+        duration, _, rest = command[5:].partition(":")
+        y, _, x = rest.partition(":")
+        try:
+            duration, y, x = int(duration), int(y), int(x)
+        except ValueError:
+            pass
+        else:
+            return handle_move_command(duration, y, x)
+
+    log.warning("Unknown command: %r", command)
+
+
+def handle_move_command(duration: int, y: int, x: int) -> None:
+    if duration < 0 or not -100 <= y <= 100 or not -100 <= x <= 100:
+        return log.warning("Invalid movement: %d %d %d", duration, y, x)
+
+    timeout = asyncio.get_running_loop().time() + duration / 1000
+    set_movement(timeout, y / 100, x / 100)
 
 
 def set_movement(timeout: float, y: float, x: float) -> None:
-    global movement
-    assert timeout >= 0
+    global movement_timer
     assert -1 <= y <= 1
     assert -1 <= x <= 1
-    movement = (timeout, y, x)
-    evaluate_movement()
 
+    # Let the event loop wake us up when this command times out,
+    # rather than polling for it
+    if movement_timer is not None:
+        movement_timer.cancel()
 
-def evaluate_movement() -> None:
-    global movement, last_movement
+    movement_timer = asyncio.get_running_loop().call_at(timeout, expire_movement)
+    evaluate_movement(y, x)
 
-    if movement is None:
-        return
 
-    timeout, y, x = movement
-    timed_out = time.perf_counter() >= timeout
-    if timed_out:
-        y, x = 0, 0
+def expire_movement() -> None:
+    global movement_timer
+    movement_timer = None
+    evaluate_movement(0, 0)
 
+
+def evaluate_movement(y: float, x: float) -> None:
+    global last_movement
+
+    if last_movement == (y, x):
+        return  # No change in movement
+
+    if log.isEnabledFor(logging.INFO):
+        log_movement(y, x)
+
+    update_motor_pins(y, x)
+    last_movement = (y, x)
+
+
+def log_movement(y: float, x: float) -> None:
     # fmt: off
     actions = []
     if   y > 0: actions.append(f"{y:.0%} forwards")
@@ -111,18 +252,10 @@ def evaluate_movement() -> None:
     elif x < 0: actions.append(f"{-x:.0%} left")
     # fmt: on
 
-    if last_movement == (y, x):
-        pass  # No change in movement
-    elif actions:
-        print("Moving", ", ".join(actions))
-        update_motor_pins(y, x)
+    if actions:
+        log.info("Moving %s", ", ".join(actions))
     else:
-        print("Stopped!")
-        update_motor_pins(y, x)
-
-    last_movement = (y, x)
-    if timed_out:
-        movement = None
+        log.info("Stopped!")
 
 
 def update_motor_pins(y: float, x: float) -> None:
@@ -130,40 +263,48 @@ def update_motor_pins(y: float, x: float) -> None:
     # x > 0 for right, x < 0 for left
     # TODO: add support for multi-directional movement and analog controls
     if y > 0:
-        M1.ChangeDutyCycle(25)
-        M2.ChangeDutyCycle(25)
-        GPIO.output(7, False)
-        GPIO.output(11, True)
-        GPIO.output(13, True)
-        GPIO.output(15, False)
+        direction = "forward"
     elif y < 0:
-        M1.ChangeDutyCycle(30)
-        M2.ChangeDutyCycle(30)
-        GPIO.output(7, True)
-        GPIO.output(11, False)
-        GPIO.output(13, False)
-        GPIO.output(15, True)
+        direction = "back"
     elif x > 0:
-        M1.ChangeDutyCycle(20)
-        M2.ChangeDutyCycle(20)
-        GPIO.output(7, True)
-        GPIO.output(11, False)
-        GPIO.output(13, True)
-        GPIO.output(15, False)
+        direction = "right"
     elif x < 0:
-        M1.ChangeDutyCycle(20)
-        M2.ChangeDutyCycle(20)
-        GPIO.output(7, False)
-        GPIO.output(11, True)
-        GPIO.output(13, False)
-        GPIO.output(15, True)
+        direction = "left"
     else:
-        GPIO.output(7, False)
-        GPIO.output(11, False)
-        GPIO.output(13, False)
-        GPIO.output(15, False)
+        direction = "stop"
+
+    values, duty = MOTOR_DIRECTIONS[direction]
+    if duty is not None:
+        set_duty_cycle(duty)
+    set_pins(values)
+
+
+def set_pins(values: tuple[bool, bool, bool, bool]) -> None:
+    global pin_values
+
+    if pin_values != values:
+        high = sum(1 << pin for pin, value in zip(MOTOR_PINS, values) if value)
+        pi.clear_bank_1(MOTOR_PINS_MASK & ~high)
+        if high:
+            pi.set_bank_1(high)
+        pin_values = values
+
+
+def set_duty_cycle(duty: float) -> None:
+    global duty_cycle
+
+    if duty_cycle != duty:
+        # hardware_PWM() takes duty cycles in millionths
+        for pin in PWM_PINS:
+            pi.hardware_PWM(pin, PWM_FREQUENCY, round(duty * 10_000))
+        duty_cycle = duty
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    asyncio.run(main())
+    try:
+        import uvloop
+    except ModuleNotFoundError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
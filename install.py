@@ -1,13 +1,12 @@
 #!/usr/bin/python3
 import argparse
+import asyncio
 import getpass
 import platform
 import shutil
-import string
 import subprocess
 import sys
 import tarfile
-import tempfile
 import urllib.request
 from pathlib import Path
 
@@ -35,10 +34,19 @@ MEDIAMTX_SOURCES = {
     "aarch64": "https://github.com/bluenviron/mediamtx/releases/download/v1.12.0/mediamtx_v1.12.0_linux_arm64v8.tar.gz",
 }
 
+NGINX_SITES_AVAILABLE = Path("/etc/nginx/sites-available")
+NGINX_SITES_ENABLED = Path("/etc/nginx/sites-enabled")
+
+# Placeholders in service files and the values to replace them with.
+SERVICE_SUBSTITUTIONS = {
+    "${PROJECT}": str(PROJECT_ROOT),
+    "${PYTHON}": str(PROJECT_ROOT / ".venv/bin/python"),
+}
+
 apt_updated = False
 
 
-def main() -> None:
+async def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--dry-run",
@@ -62,16 +70,32 @@ def main() -> None:
     skip_camera: bool = args.skip_camera
 
     check_camera(skip_camera=skip_camera)
-    maybe_download_mediamtx(dry_run=dry_run, force_mediamtx_arch=force_mediamtx_arch)
 
     apt_cache = AptCache()
     apt_cache.open()
 
-    maybe_install_nginx(apt_cache, dry_run=dry_run)
-    copy_html_files(dry_run=dry_run)
-    update_nginx_config(dry_run=dry_run)
+    # The mediamtx download doesn't depend on anything else,
+    # so run it while apt and pip do their work
+    results = await asyncio.gather(
+        asyncio.to_thread(
+            maybe_download_mediamtx,
+            dry_run=dry_run,
+            force_mediamtx_arch=force_mediamtx_arch,
+        ),
+        install_packages(apt_cache, dry_run=dry_run),
+        return_exceptions=True,
+    )
+
+    # Only bail out once every step has finished, so a failed download
+    # can't interrupt apt partway through installing packages
+    for result in results:
+        if isinstance(result, RuntimeError):
+            sys.exit(f"{result}, aborting.")
+        elif isinstance(result, BaseException):
+            raise result
 
-    maybe_create_venv(apt_cache, dry_run=dry_run)
+    copy_html_files(dry_run=dry_run)
+    await update_nginx_config(dry_run=dry_run)
 
     update_mediamtx_service(dry_run=dry_run)
     update_controller_service(dry_run=dry_run)
@@ -103,15 +127,17 @@ def maybe_download_mediamtx(
     elif dry_run:
         return print(f"Would download mediamtx {arch} to /usr/local/bin/")
 
-    print(f"Downloading mediamtx {arch}...")
-    with tempfile.TemporaryFile("wb+") as f:
-        with urllib.request.urlopen(MEDIAMTX_SOURCES[arch]) as response:
-            shutil.copyfileobj(response, f)
-
-        print("Extracting to /usr/local/bin/...")
-        f.seek(0)
-        with tarfile.open(fileobj=f, mode="r:gz") as archive:
-            archive.extract("mediamtx", "/usr/local/bin")
+    # Extract while downloading, using the streaming "r|gz" mode since
+    # the response can't seek
+    print(f"Downloading and extracting mediamtx {arch} to /usr/local/bin/...")
+    with urllib.request.urlopen(MEDIAMTX_SOURCES[arch]) as response:
+        with tarfile.open(fileobj=response, mode="r|gz") as archive:
+            for member in archive:
+                if member.name == "mediamtx":
+                    archive.extract(member, "/usr/local/bin")
+                    break
+            else:
+                raise RuntimeError("mediamtx not found in downloaded archive")
 
 
 def update_apt(apt_cache: AptCache, *, dry_run: bool) -> None:
@@ -129,6 +155,16 @@ def update_apt(apt_cache: AptCache, *, dry_run: bool) -> None:
         apt_updated = True
 
 
+async def install_packages(apt_cache: AptCache, *, dry_run: bool) -> None:
+    await asyncio.to_thread(install_apt_packages, apt_cache, dry_run=dry_run)
+    await maybe_create_venv(apt_cache, dry_run=dry_run)
+
+
+def install_apt_packages(apt_cache: AptCache, *, dry_run: bool) -> None:
+    maybe_install_nginx(apt_cache, dry_run=dry_run)
+    maybe_install_pigpio(apt_cache, dry_run=dry_run)
+
+
 def maybe_install_nginx(apt_cache: AptCache, *, dry_run: bool) -> None:
     nginx = apt_cache["nginx"]
     if nginx.is_installed:
@@ -143,6 +179,20 @@ def maybe_install_nginx(apt_cache: AptCache, *, dry_run: bool) -> None:
         apt_cache.commit()
 
 
+def maybe_install_pigpio(apt_cache: AptCache, *, dry_run: bool) -> None:
+    pigpio = apt_cache["pigpio"]
+    if pigpio.is_installed:
+        return
+
+    update_apt(apt_cache, dry_run=dry_run)
+    if dry_run:
+        print("Would install pigpio")
+    else:
+        print("Installing pigpio...")
+        pigpio.mark_install()
+        apt_cache.commit()
+
+
 def copy_html_files(*, dry_run: bool) -> None:
     if dry_run:
         return print("Would copy HTML files to /var/www/html/")
@@ -151,8 +201,8 @@ def copy_html_files(*, dry_run: bool) -> None:
     shutil.copytree(PROJECT_ROOT / "var/www/html/", "/var/www/html/", dirs_exist_ok=True)
 
 
-def update_nginx_config(*, dry_run: bool) -> None:
-    default = Path("/etc/nginx/sites-enabled/default")
+async def update_nginx_config(*, dry_run: bool) -> None:
+    default = NGINX_SITES_ENABLED / "default"
     if not default.is_file():
         pass
     elif dry_run:
@@ -162,9 +212,7 @@ def update_nginx_config(*, dry_run: bool) -> None:
         default.unlink()
 
     src_sites = list(PROJECT_ROOT.joinpath("etc/nginx/sites-available").iterdir())
-    dest_sites: list[Path] = [
-        Path("/etc/nginx/sites-available") / path.name for path in src_sites
-    ]
+    dest_sites: list[Path] = [NGINX_SITES_AVAILABLE / path.name for path in src_sites]
 
     if not src_sites:
         pass
@@ -173,36 +221,50 @@ def update_nginx_config(*, dry_run: bool) -> None:
         print("Would add symlinks to /etc/nginx/sites-enabled/")
         print("Would restart nginx")
     else:
+        # Writes to SD cards are slow, so issue them all at once
         print("Copying nginx configuration to /etc/nginx/sites-available/...")
-        for src, dest in zip(src_sites, dest_sites):
-            shutil.copyfile(src, dest)
+        await asyncio.gather(
+            *[
+                asyncio.to_thread(shutil.copyfile, src, dest)
+                for src, dest in zip(src_sites, dest_sites)
+            ]
+        )
 
         print("Adding symlinks to /etc/nginx/sites-enabled/...")
-        for dest in dest_sites:
-            link = Path("/etc/nginx/sites-enabled").joinpath(dest.name)
-            if link.resolve() == dest:
-                continue
-
-            link.symlink_to(dest)
+        await asyncio.gather(
+            *[asyncio.to_thread(maybe_enable_site, dest) for dest in dest_sites]
+        )
 
         print("Restarting nginx...")
-        check_call("systemctl", "restart", "nginx")
+        await check_call_async("systemctl", "restart", "nginx")
+
+
+def maybe_enable_site(dest: Path) -> None:
+    link = NGINX_SITES_ENABLED / dest.name
+    if link.resolve() == dest:
+        return
 
+    link.symlink_to(dest)
 
-def maybe_create_venv(apt_cache: AptCache, *, dry_run: bool) -> None:
+
+async def maybe_create_venv(apt_cache: AptCache, *, dry_run: bool) -> None:
     venv = PROJECT_ROOT.joinpath(".venv")
     if venv.is_dir():
         return
 
-    maybe_install_python_dev(apt_cache, dry_run=dry_run)
+    # Installing python3-dev may upgrade the system Python, so it has to
+    # finish before we start running pip from it
+    await asyncio.to_thread(maybe_install_python_dev, apt_cache, dry_run=dry_run)
 
     if dry_run:
         return print("Would create controller.py virtual environment")
 
     print("Creating controller.py virtual environment...")
-    check_call(sys.executable, "-m", "venv", venv)
+    await check_call_async(sys.executable, "-m", "venv", venv)
     print("Installing controller.py dependencies...")
-    check_call(venv / "bin/pip", "install", "-r", PROJECT_ROOT / "requirements.txt")
+    await check_call_async(
+        venv / "bin/pip", "install", "-r", PROJECT_ROOT / "requirements.txt"
+    )
 
 
 def maybe_install_python_dev(apt_cache: AptCache, *, dry_run: bool) -> None:
@@ -235,18 +297,13 @@ def copy_service_file(src: Path, *, dry_run: bool) -> None:
 
     print(f"Copying {src.name} to /etc/systemd/system/...")
     dest = Path("/etc/systemd/system") / src.name
-    content = src.read_text("utf8")
-    content = replace_service_substitutions(content)
-    dest.write_text(content, "utf8")
+    dest.write_text(replace_service_substitutions(src.read_text("utf8")), "utf8")
 
 
 def replace_service_substitutions(content: str) -> str:
-    return string.Template(content).substitute(
-        {
-            "PROJECT": PROJECT_ROOT,
-            "PYTHON": PROJECT_ROOT / ".venv/bin/python",
-        }
-    )
+    for placeholder, value in SERVICE_SUBSTITUTIONS.items():
+        content = content.replace(placeholder, value)
+    return content
 
 
 def restart_services(*, dry_run: bool) -> None:
@@ -257,10 +314,14 @@ def restart_services(*, dry_run: bool) -> None:
     check_call("systemctl", "daemon-reload")
 
     print("Enabling services...")
-    check_call("systemctl", "enable", "zerobot-mediamtx", "zerobot-controller")
+    check_call(
+        "systemctl", "enable", "pigpiod", "zerobot-mediamtx", "zerobot-controller"
+    )
 
     print("Restarting services...")
-    check_call("systemctl", "restart", "zerobot-mediamtx", "zerobot-controller")
+    check_call(
+        "systemctl", "restart", "pigpiod", "zerobot-mediamtx", "zerobot-controller"
+    )
 
 
 def check_call(*args: object) -> None:
@@ -268,10 +329,21 @@ def check_call(*args: object) -> None:
     subprocess.check_call(str_args, stdout=subprocess.DEVNULL)
 
 
+async def check_call_async(*args: object) -> None:
+    str_args = [str(x) for x in args]
+    process = await asyncio.create_subprocess_exec(
+        *str_args,
+        stdout=subprocess.DEVNULL,
+    )
+    returncode = await process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, str_args)
+
+
 def check_output(*args: object) -> str:
     str_args = [str(x) for x in args]
     return subprocess.check_output(str_args, text=True)
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -38,10 +38,10 @@ function connectRemoteControls() {
 
 window.addEventListener("load", connectRemoteControls)
 
-function sendCommand(message) {
+function sendCommand(message, data = message) {
     if (ws.readyState !== WebSocket.OPEN) return;
     logMessage(`Sending ${message}`)
-    ws.send(message)
+    ws.send(data)
 }
 
 // Show messages on the dashboard
@@ -117,7 +117,13 @@ function sendMovementCommand() {
     // won't move forever if the client drops.
     let timeout = Math.floor(MOVEMENT_RATE * 2)
 
-    sendCommand(`move:${timeout}:${y}:${x}`)
+    // Pack the command as a little-endian uint16 timeout, int8 y, and int8 x.
+    let data = new DataView(new ArrayBuffer(4))
+    data.setUint16(0, timeout, true)
+    data.setInt8(2, y)
+    data.setInt8(3, x)
+
+    sendCommand(`move:${timeout}:${y}:${x}`, data.buffer)
     stopped = (y === 0 && x === 0)
 }
 